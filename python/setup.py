@@ -0,0 +1,21 @@
+""" Builds the optional Cython kernels: python setup.py build_ext --inplace
+
+The parallel kernels are compiled with OpenMP. Set SUMQUERY_NO_OPENMP=1 to build without it,
+e.g. with Apple clang, in which case they run serially.
+"""
+
+import os
+import sys
+
+from setuptools import Extension, setup
+from Cython.Build import cythonize
+
+if os.environ.get("SUMQUERY_NO_OPENMP"):
+    compileArgs, linkArgs = [], []
+elif sys.platform == "win32":
+    compileArgs, linkArgs = ["/openmp"], []
+else:
+    compileArgs, linkArgs = ["-fopenmp"], ["-fopenmp"]
+
+setup(ext_modules=cythonize(Extension("sumQueryExt", ["sumQueryExt.pyx"],
+                                      extra_compile_args=compileArgs, extra_link_args=linkArgs)))
@@ -4,8 +4,25 @@ Author : Nabil Ibtehaz
 Author : Rickard Norlander
 """
 
+import numbers
+import operator
+
 import numpy as np
 
+try:
+    # Ahead-of-time compiled kernels, present if sumQueryExt.pyx has been built with
+    # python setup.py build_ext --inplace. Unlike the Numba ones they need no JIT.
+    from sumQueryExt import (DTYPES, update_by_x, update_by_x_parallel, update_batch, query_by_x,
+                             query_by_x_parallel, query_batch)
+except ImportError:
+    from sumQueryNumba import (DTYPES, update_by_x, update_by_x_parallel, update_batch, query_by_x,
+                               query_by_x_parallel, query_batch)
+
+try:
+    import sumQueryCuda
+except ImportError:
+    sumQueryCuda = None
+
 
 # Update
 # ------
@@ -22,32 +39,61 @@ import numpy as np
 # x-contained                 partialBoth      partialX
 # x-contained or x-partial      partialY       fullBoth
 #
+#
+# Both layers are heap indexed: the root is 1, the children of k are 2k and 2k+1, and with
+# size rounded up to a power of two the leaf for coordinate c is size + c. A node k at height h
+# (leaves have height 0) covers [(k << h) - size, ((k + 1) << h) - size - 1], so the node at height
+# h that contains coordinate c covers c with its low h bits cleared up to c with them set.
+#
+# Any range [qLo, qHi] splits into O(log(size)) nodes that are fully inside it, found bottom-up
+# as in an iterative segment tree, plus the nodes partially inside it. The latter are
+# exactly the ancestors of the leaves qLo and qHi that are not fully inside.
 
-class Node(object):
-    def __init__(self):
-        self.partialBoth = 0
-        self.partialY = 0
-        self.partialX = 0
-        self.fullBoth = 0
 
 class SegmentTree2D(object):
 
-    def __init__(self, n, m):
+    def __init__(self, n, m, parallel=False, dtype=np.int64):
         """
         Initializes the tree
 
         Arguments:
             n {int} -- number of rows in the matrix
             m {int} -- number of columns in the matrix
+            parallel {bool} -- process the 1st layer nodes of each update and query in parallel.
+                               Only pays off when the thread start-up cost is small compared to
+                               the work per 2nd layer tree, i.e. for large m. With the Cython
+                               kernels this needs an OpenMP build, see setup.py.
+            dtype {numpy dtype} -- storage type of the tree, np.int64, np.int32 or np.float64.
+                                   np.int32 halves the memory traffic, but is only exact while
+                                   the sum of |v| times the area over all updates fits in 32
+                                   bits. np.float64 accepts non-integer values, and its sums
+                                   are floats subject to rounding.
         """
+        if np.dtype(dtype).name not in DTYPES:
+            raise ValueError("dtype must be one of %s, not %s" % (", ".join(DTYPES), np.dtype(dtype).name))
+        # Also accepts numpy integers, which have no bit_length.
+        n = operator.index(n)
+        m = operator.index(m)
         self.n = n
         self.m = m
-        self.tree = []
-        for i in range(4 * n):
-            row = []
-            for j in range(4 * m):
-                row.append(Node())
-            self.tree.append(row)
+        self._update_by_x = update_by_x_parallel if parallel else update_by_x
+        self._query_by_x = query_by_x_parallel if parallel else query_by_x
+        # Number of leaves of each layer, rounded up to a power of two.
+        self.N = 1 << (n - 1).bit_length()
+        self.M = 1 << (m - 1).bit_length()
+        # Node (i, j), i.e. (index along 1st layer tree, index along 2nd layer tree), is row
+        # i * stride + j. Its four fields are next to each other, so they share a cache line.
+        self.stride = 2 * self.M
+        self.tree = np.zeros((2 * self.N * self.stride, 4), dtype=dtype)
+        self.partialBoth = self.tree[:, 0]
+        self.partialY = self.tree[:, 1]
+        self.partialX = self.tree[:, 2]
+        self.fullBoth = self.tree[:, 3]
+        # Values and sums are floats for a float64 tree, and ints otherwise.
+        self._float = self.tree.dtype.kind == "f"
+        self._sumType = np.float64 if self._float else np.int64
+        # Copy of the tree on the GPU for queryBatch, dropped by every update.
+        self._deviceTree = None
 
     def update(self, qxLo, qxHi, qyLo, qyHi, v):
         """
@@ -58,9 +104,31 @@ class SegmentTree2D(object):
             qxHi {int} -- end of x dimension
             qyLo {int} -- start of y dimension
             qyHi {int} -- end of y dimension
-            v {float/int} -- value to be added
+            v {int/float} -- value to be added. Floats are only accepted by a float64 tree, the
+                             integer trees raise TypeError rather than truncating them.
         """
-        self.updateByX((0, 0), 0, self.n-1, qxLo, qxHi, qyLo, qyHi, v)
+        v = self._value(v)
+        qxLo, qxHi, qyLo, qyHi = self._clip(qxLo, qxHi, qyLo, qyHi)
+        if qxLo > qxHi or qyLo > qyHi:
+            return
+        self._deviceTree = None
+        self._update_by_x(self.tree, self.N, self.M, qxLo, qxHi, qyLo, qyHi, v)
+
+    def updateBatch(self, qxLo, qxHi, qyLo, qyHi, v):
+        """
+        Applies many updates at once, equivalent to calling update for each index in turn
+
+        Arguments:
+            qxLo {array_like} -- start of x dimension of each update
+            qxHi {array_like} -- end of x dimension of each update
+            qyLo {array_like} -- start of y dimension of each update
+            qyHi {array_like} -- end of y dimension of each update
+            v {array_like} -- value to be added by each update, see update
+        """
+        inside, (qxLo, qxHi, qyLo, qyHi, v) = self._clipBatch(qxLo, qxHi, qyLo, qyHi, v)
+        qxLo, qxHi, qyLo, qyHi, v = [a[inside] for a in (qxLo, qxHi, qyLo, qyHi, v)]
+        self._deviceTree = None
+        update_batch(self.tree, self.N, self.M, qxLo, qxHi, qyLo, qyHi, v)
 
     def query(self, qxLo, qxHi, qyLo, qyHi):
         """
@@ -72,167 +140,133 @@ class SegmentTree2D(object):
             qyLo {int} -- start of y dimension
             qyHi {int} -- end of y dimension
         """
-        return self.queryByX((0, 0), 0, self.n-1, qxLo, qxHi, qyLo, qyHi)
+        qxLo, qxHi, qyLo, qyHi = self._clip(qxLo, qxHi, qyLo, qyHi)
+        result = 0
+        if qxLo <= qxHi and qyLo <= qyHi:
+            result = self._query_by_x(self.tree, self.N, self.M, qxLo, qxHi, qyLo, qyHi)
+        return float(result) if self._float else int(result)
 
-    def updateByX(self, nodeID, xLo, xHi, qxLo, qxHi, qyLo, qyHi, v):
+    def queryBatch(self, qxLo, qxHi, qyLo, qyHi, gpu=False):
         """
-        Updates along x dimension
+        Answers many queries at once, equivalent to calling query for each index in turn
 
         Arguments:
-            nodeID {tuple} -- (index along 1st layer tree, index along 2nd layer tree)
-            xLo {int} -- start of x dimension of the region under the node
-            xHi {int} -- end of x dimension of the region under the node
-            qxLo {int} -- start of x dimension of update region
-            qxHi {int} -- end of x dimension of update region
-            qyLo {int} -- start of y dimension of update region
-            qyHi {int} -- end of y dimension of update region
-            v {float/int} -- value to be added
-        """
-        if qxHi < xLo or xHi < qxLo:
-            # X-disjoint
-            return
-        if qxLo <= xLo and xHi <= qxHi:
-            # Fully inside query. Done with x-dimension.
-            self.updateByY(nodeID, xLo, xHi, 0, self.m-1, qxLo, qxHi, qyLo, qyHi, v, True)
-            return
-
-        # Now know that node is partially inside query.
-        xMid = (xLo + xHi) // 2
-        left = (nodeID[0] * 2 + 1, nodeID[1])
-        right = (left[0] + 1, left[1])
-
-        # Update children.
-        self.updateByX(left, xLo, xMid, qxLo, qxHi, qyLo, qyHi, v)
-        self.updateByX(right, xMid + 1, xHi, qxLo, qxHi, qyLo, qyHi, v)
-
-        # Also update this node itself.
-        self.updateByY(nodeID, xLo, xHi, 0, self.m-1, qxLo, qxHi, qyLo, qyHi, v , False)
-
-    def updateByY(self, nodeID, xLo, xHi, yLo, yHi, qxLo, qxHi, qyLo, qyHi, v, covered):
+            qxLo {array_like} -- start of x dimension of each query
+            qxHi {array_like} -- end of x dimension of each query
+            qyLo {array_like} -- start of y dimension of each query
+            qyHi {array_like} -- end of y dimension of each query
+            gpu {bool} -- answer the queries on the GPU, one per thread. The tree is copied to the
+                          device on first use and kept there until the next update, so this pays
+                          off for large batches against a tree that doesn't change in between.
+                          Needs a CUDA device and Numba's CUDA support.
+
+        Returns:
+            ndarray -- the sum of each query, as int64, or float64 for a float64 tree
         """
-        Updates along y dimension
-
-        Arguments:
-            nodeID {tuple} -- (index along 1st layer tree, index along 2nd layer tree)
-            xLo {int} -- start of x dimension of the region under the node
-            xHi {int} -- end of x dimension of the region under the node
-            yLo {int} -- start of y dimension of the region under the node
-            yHi {int} -- end of y dimension of the region under the node
-            qxLo {int} -- start of x dimension of update region
-            qxHi {int} -- end of x dimension of update region
-            qyLo {int} -- start of y dimension of update region
-            qyHi {int} -- end of y dimension of update region
-            v {float/int} -- value to be added, scaled appropriately
-            covered {bool} -- True if x region is fully contained within the update region
-        """
-        if qyHi < yLo or yHi < qyLo:
-            # Y-disjoint
-            return
-        node = self.tree[nodeID[0]][nodeID[1]]
-        if qyLo <= yLo and yHi <= qyHi:
-            # Fully inside on y-dimension.
-            if covered:
-                # Fully inside on both dimensions.
-                node.fullBoth += v
-                node.partialY += v * (yHi - yLo + 1)
-            else:
-                # Fully inside on y but not x.
-                txLo = max(qxLo, xLo)
-                txHi = min(qxHi, xHi)
-                node.partialX += v * (txHi - txLo + 1)
-                node.partialBoth += v * (txHi - txLo + 1) * (yHi - yLo + 1)
+        inside, (qxLo, qxHi, qyLo, qyHi) = self._clipBatch(qxLo, qxHi, qyLo, qyHi)
+        out = np.zeros(inside.shape[0], dtype=self._sumType)
+        qxLo, qxHi, qyLo, qyHi = [a[inside] for a in (qxLo, qxHi, qyLo, qyHi)]
+        if gpu:
+            if sumQueryCuda is None or not sumQueryCuda.available():
+                raise RuntimeError("queryBatch(gpu=True) needs a CUDA device and Numba's CUDA support")
+            if self._deviceTree is None:
+                self._deviceTree = sumQueryCuda.to_device(self.tree)
+            out[inside] = sumQueryCuda.query_batch(self._deviceTree, self.N, self.M, qxLo, qxHi, qyLo, qyHi)
         else:
-            yMid = (yLo + yHi) // 2
-            leftID = (nodeID[0], nodeID[1] * 2 + 1)
-            rightID = (leftID[0], leftID[1] + 1)
-
-            self.updateByY(leftID, xLo, xHi, yLo, yMid, qxLo, qxHi, qyLo, qyHi, v, covered)
-            self.updateByY(rightID, xLo, xHi, yMid + 1, yHi, qxLo, qxHi, qyLo, qyHi, v, covered)
-
-            left_node = self.tree[leftID[0]][leftID[1]]
-            right_node = self.tree[rightID[0]][rightID[1]]
+            result = np.empty(qxLo.shape[0], dtype=self._sumType)
+            query_batch(self.tree, self.N, self.M, qxLo, qxHi, qyLo, qyHi, result)
+            out[inside] = result
+        return out
 
-            node.partialBoth = left_node.partialBoth + right_node.partialBoth + node.partialX * (yHi - yLo + 1)
-            node.partialY = left_node.partialY + right_node.partialY + node.fullBoth * (yHi - yLo + 1)
-
-    def queryByX(self, nodeID, xLo, xHi, qxLo, qxHi, qyLo, qyHi):
+    def _clip(self, qxLo, qxHi, qyLo, qyHi):
         """
-        Queries along x dimension
-
-        Arguments:
-            nodeID {tuple} -- (index along 1st layer tree, index along 2nd layer tree)
-            xLo {int} -- start of x dimension of the region under the node
-            xHi {int} -- end of x dimension of the region under the node
-            qxLo {int} -- start of x dimension of update region
-            qxHi {int} -- end of x dimension of update region
-            qyLo {int} -- start of y dimension of update region
-            qyHi {int} -- end of y dimension of update region
+        Clips a range to the matrix. The kernels assume that the range lies within it, and
+        would index past the tree otherwise. Raises TypeError if a coordinate is not an integer.
         """
-        if qxHi < xLo or xHi < qxLo:
-            # X-disjoint
-            return 0
-        if qxLo <= xLo and xHi <= qxHi:
-            # Fully inside query. Done with x-dimension.
-            return self.queryByY(nodeID, xLo, xHi, 0, self.m-1, qxLo, qxHi, qyLo, qyHi)
-
-        # Now know that node is partially inside query.
-        xMid = (xLo + xHi) // 2
-        left = (nodeID[0] * 2 + 1, nodeID[1])
-        right = (left[0] + 1, left[1])
+        index = operator.index
+        return (max(index(qxLo), 0), min(index(qxHi), self.n - 1),
+                max(index(qyLo), 0), min(index(qyHi), self.m - 1))
 
-        left_result = self.queryByX(left, xLo, xMid, qxLo, qxHi, qyLo, qyHi)
-        right_result = self.queryByX(right, xMid + 1, xHi, qxLo, qxHi, qyLo, qyHi)
-
-        txLo = max(qxLo, xLo)
-        txHi = min(qxHi, xHi)
-
-        this_result = self.queryByY(nodeID, xLo, xHi, 0, self.m-1, txLo, txHi, qyLo, qyHi)
-        return left_result + right_result + this_result
+    def _value(self, v):
+        """
+        Checks an update value. The integer trees take Python ints, so that values outside
+        int64 raise OverflowError, and the float64 tree takes floats.
+        """
+        if not self._float:
+            return operator.index(v)
+        if not isinstance(v, numbers.Real):
+            raise TypeError("value must be a real number, not %s" % type(v).__name__)
+        return float(v)
 
-    def queryByY(self, nodeID, xLo, xHi, yLo, yHi, qxLo, qxHi, qyLo, qyHi):
+    def _values(self, v):
         """
-        Queries along y dimension
+        Same as _value for an array of update values, which it casts to a flat array of the
+        type the kernels take
+        """
+        if not self._float:
+            return _toInt64(v)
+        if v.size and v.dtype.kind not in "biufO":
+            raise TypeError("batch values must be real numbers, not %s" % v.dtype)
+        return np.ascontiguousarray(v, dtype=np.float64).ravel()
 
-        Arguments:
-            nodeID {tuple} -- (index along 1st layer tree, index along 2nd layer tree)
-            xLo {int} -- start of x dimension of the region under the node
-            xHi {int} -- end of x dimension of the region under the node
-            yLo {int} -- start of y dimension of the region under the node
-            yHi {int} -- end of y dimension of the region under the node
-            qxLo {int} -- start of x dimension of update region
-            qxHi {int} -- end of x dimension of update region
-            qyLo {int} -- start of y dimension of update region
-            qyHi {int} -- end of y dimension of update region
-        """
-        if qyHi < yLo or yHi < qyLo:
-            # Y-disjoint
-            return 0
-
-        node = self.tree[nodeID[0]][nodeID[1]]
-        if qyLo <= yLo and yHi <= qyHi:
-            # Fully inside on y-dimension.
-            if qxLo <= xLo and xHi <= qxHi:
-                # Fully inside on both dimensions.
-                return node.partialBoth + node.partialY * (xHi - xLo + 1)
-            else:
-                # Fully inside on y but not x.
-                scaled_value = node.partialY * (qxHi - qxLo + 1)
-                return scaled_value
-
-        # Now know that node is partially inside query on y-dimension.
-        yMid = (yLo + yHi) // 2
-        left = (nodeID[0], nodeID[1] * 2 + 1)
-        right = (left[0], left[1] + 1)
-
-        tyLo = max(yLo, qyLo)
-        tyHi = min(yHi, qyHi)
-        txLo = max(xLo, qxLo)
-        txHi = min(xHi, qxHi)
-        lazy_result = node.fullBoth * (txHi - txLo + 1) * (tyHi - tyLo + 1)
-
-        if qxLo <= xLo and xHi <= qxHi:
-            lazy_result += node.partialX * (tyHi - tyLo + 1)
-
-        left_result = self.queryByY(left, xLo, xHi, yLo, yMid, qxLo, qxHi, qyLo, qyHi)
-        right_result = self.queryByY(right, xLo, xHi, yMid + 1, yHi, qxLo, qxHi, qyLo, qyHi)
-        return left_result + right_result + lazy_result
+    def _clipBatch(self, qxLo, qxHi, qyLo, qyHi, *rest):
+        """
+        Broadcasts the arguments of a batch to flat int64 arrays and clips the ranges to the
+        matrix. Also returns a mask of the ranges that are not empty after clipping. The
+        coordinates are clipped before they are cast, so none of them wrap. The values in rest
+        are checked as in update.
+        """
+        arrays = np.broadcast_arrays(*[_asArray(a) for a in (qxLo, qxHi, qyLo, qyHi) + rest])
+        qxLo, qxHi = [_toInt64(a, -1, self.n) for a in arrays[:2]]
+        qyLo, qyHi = [_toInt64(a, -1, self.m) for a in arrays[2:4]]
+        rest = [self._values(a) for a in arrays[4:]]
+        qxLo = np.maximum(qxLo, 0)
+        qxHi = np.minimum(qxHi, self.n - 1)
+        qyLo = np.maximum(qyLo, 0)
+        qyHi = np.minimum(qyHi, self.m - 1)
+        inside = (qxLo <= qxHi) & (qyLo <= qyHi)
+        return inside, [qxLo, qxHi, qyLo, qyHi] + rest
+
+
+def _asArray(a):
+    """
+    np.asarray, except that sequences mixing negative ints with ints of 2**63 or more become
+    object arrays rather than lossy float64 ones
+    """
+    array = np.asarray(a)
+    if array.dtype.kind == "f" and not isinstance(a, np.ndarray):
+        array = np.asarray(a, dtype=object)
+    return array
+
+
+def _toInt64(a, lo=None, hi=None):
+    """
+    Casts an array of integers to a flat int64 array without wrapping. Raises TypeError if it
+    holds anything else.
+
+    Arguments:
+        a {ndarray} -- the array to cast, of any integer dtype or of Python ints
+        lo {int} -- values below lo become lo. If None, the values must fit in int64 instead,
+                    or OverflowError is raised.
+        hi {int} -- values above hi become hi, see lo
+    """
+    if a.dtype.kind == "O":
+        a = np.array([operator.index(x) for x in a.ravel()], dtype=object).reshape(a.shape)
+    elif a.size and a.dtype.kind not in "biu":
+        raise TypeError("batch arguments must be integers, not %s" % a.dtype)
+    if lo is None:
+        low = a < np.iinfo(np.int64).min
+        high = a > np.iinfo(np.int64).max
+        if low.any() or high.any():
+            raise OverflowError("batch values must fit in int64")
+    else:
+        low = a < lo
+        high = a > hi
+    # Only values that are within range are cast.
+    out = np.empty(a.shape, dtype=np.int64)
+    within = ~(low | high)
+    out[within] = a[within]
+    if lo is not None:
+        out[low] = lo
+        out[high] = hi
+    return out.ravel()
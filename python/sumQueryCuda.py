@@ -0,0 +1,157 @@
+""" CUDA kernels of the 2D Segment Tree, see sumQuery.py for the layout of the tree
+
+Only queries run on the GPU. They are read-only, so a batch of them can run one per thread
+against a copy of the tree in device memory without any synchronization.
+
+Author : Rickard Norlander
+"""
+
+import numpy as np
+from numba import cuda
+
+
+# Columns of the tree array, see sumQueryNumba.py.
+_PB, _PY, _PX, _FB = 0, 1, 2, 3
+
+THREADS_PER_BLOCK = 128
+
+
+def available():
+    """
+    True if there is a CUDA device to run on
+    """
+    return cuda.is_available()
+
+
+def to_device(tree):
+    """
+    Copies the tree array to device memory, for query_batch
+    """
+    return cuda.to_device(tree)
+
+
+@cuda.jit(device=True)
+def _overlap(c, width, qLo, qHi):
+    """
+    See sumQueryNumba._overlap
+    """
+    mask = width - 1
+    lo = max(c & ~mask, qLo)
+    hi = min(c | mask, qHi)
+    return hi - lo + 1
+
+
+@cuda.jit(device=True)
+def _query_by_y(tree, row, M, qyLo, qyHi, xWidth, covered):
+    """
+    See sumQueryNumba._query_by_y
+    """
+    result = 0
+
+    # Nodes fully inside on y-dimension.
+    l = qyLo + M
+    r = qyHi + M + 1
+    while l < r:
+        if l & 1:
+            result += tree[row + l, _PY] * xWidth
+            if covered:
+                result += tree[row + l, _PB]
+            l += 1
+        if r & 1:
+            r -= 1
+            result += tree[row + r, _PY] * xWidth
+            if covered:
+                result += tree[row + r, _PB]
+        l >>= 1
+        r >>= 1
+
+    # Nodes partially inside on y-dimension.
+    lo = qyLo + M
+    hi = qyHi + M
+    width = 1
+    while lo > 1:
+        lo >>= 1
+        hi >>= 1
+        width <<= 1
+        yWidth = _overlap(qyLo, width, qyLo, qyHi)
+        if yWidth < width:
+            result += tree[row + lo, _FB] * xWidth * yWidth
+            if covered:
+                result += tree[row + lo, _PX] * yWidth
+        if hi != lo:
+            yWidth = _overlap(qyHi, width, qyLo, qyHi)
+            if yWidth < width:
+                result += tree[row + hi, _FB] * xWidth * yWidth
+                if covered:
+                    result += tree[row + hi, _PX] * yWidth
+    return result
+
+
+@cuda.jit(device=True)
+def _query_by_x(tree, N, M, qxLo, qxHi, qyLo, qyHi):
+    """
+    Same as sumQueryNumba.query_by_x, but queries each x node as soon as it is found instead of
+    listing them in a scratch array first
+    """
+    stride = 2 * M
+    result = 0
+
+    # Nodes fully inside on x-dimension.
+    l = qxLo + N
+    r = qxHi + N + 1
+    xWidth = 1
+    while l < r:
+        if l & 1:
+            result += _query_by_y(tree, l * stride, M, qyLo, qyHi, xWidth, True)
+            l += 1
+        if r & 1:
+            r -= 1
+            result += _query_by_y(tree, r * stride, M, qyLo, qyHi, xWidth, True)
+        l >>= 1
+        r >>= 1
+        xWidth <<= 1
+
+    # Nodes partially inside on x-dimension.
+    lo = qxLo + N
+    hi = qxHi + N
+    width = 1
+    while lo > 1:
+        lo >>= 1
+        hi >>= 1
+        width <<= 1
+        xWidth = _overlap(qxLo, width, qxLo, qxHi)
+        if xWidth < width:
+            result += _query_by_y(tree, lo * stride, M, qyLo, qyHi, xWidth, False)
+        if hi != lo:
+            xWidth = _overlap(qxHi, width, qxLo, qxHi)
+            if xWidth < width:
+                result += _query_by_y(tree, hi * stride, M, qyLo, qyHi, xWidth, False)
+    return result
+
+
+@cuda.jit
+def _query_batch_kernel(tree, N, M, qxLo, qxHi, qyLo, qyHi, out):
+    """
+    Answers query i in thread i
+    """
+    i = cuda.grid(1)
+    if i < out.shape[0]:
+        out[i] = _query_by_x(tree, N, M, qxLo[i], qxHi[i], qyLo[i], qyHi[i])
+
+
+def query_batch(deviceTree, N, M, qxLo, qxHi, qyLo, qyHi):
+    """
+    Answers a batch of queries on the GPU, see sumQueryNumba.query_batch
+
+    Arguments:
+        deviceTree {DeviceNDArray} -- the tree array, already copied to the device
+        N {int} -- number of leaves of the 1st layer tree
+        M {int} -- number of leaves of the 2nd layer tree
+        qxLo, qxHi, qyLo, qyHi {ndarray} -- one entry per query
+    """
+    out = cuda.device_array(qxLo.shape[0], dtype=np.float64 if deviceTree.dtype.kind == "f" else np.int64)
+    blocks = (qxLo.shape[0] + THREADS_PER_BLOCK - 1) // THREADS_PER_BLOCK
+    if blocks > 0:
+        _query_batch_kernel[blocks, THREADS_PER_BLOCK](deviceTree, N, M, cuda.to_device(qxLo), cuda.to_device(qxHi),
+                                                      cuda.to_device(qyLo), cuda.to_device(qyHi), out)
+    return out.copy_to_host()
@@ -0,0 +1,322 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+""" Cython kernels of the 2D Segment Tree, see sumQuery.py for the layout of the tree
+
+These mirror sumQueryNumba.py and are used instead of it once built with
+
+    python setup.py build_ext --inplace
+
+Author : Rickard Norlander
+"""
+
+from cython.parallel import prange
+from libc.stdint cimport int32_t, int64_t
+
+# Storage type of the tree, see sumQueryNumba.DTYPES.
+ctypedef fused value_t:
+    int64_t
+    int32_t
+    double
+
+# Type of the values and sums, int64 for the integer trees and double for the float64 one.
+# sumQuery always passes the one that matches the tree. The other combinations are compiled too,
+# which is why the kernels cast explicitly between the two types.
+ctypedef fused sum_t:
+    int64_t
+    double
+
+DTYPES = ("int64", "int32", "float64")
+
+# Columns of the tree array, see sumQueryNumba.py.
+cdef enum:
+    _PB = 0
+    _PY = 1
+    _PX = 2
+    _FB = 3
+
+# Upper bound on the number of 1st layer nodes touched by a range, four per level. The x kernels
+# list those nodes in arrays on their own stack, so concurrent calls without the GIL never share
+# them.
+cdef enum:
+    _MAX_NODES = 256
+
+MAX_NODES = _MAX_NODES
+
+
+cdef inline int64_t _overlap(int64_t c, int64_t width, int64_t qLo, int64_t qHi) noexcept nogil:
+    """
+    Number of coordinates within [qLo, qHi] of the node of the given width that contains coordinate c
+    """
+    cdef int64_t mask = width - 1
+    cdef int64_t lo = c & ~mask
+    cdef int64_t hi = c | mask
+    lo = qLo if qLo > lo else lo
+    hi = qHi if qHi < hi else hi
+    return hi - lo + 1
+
+
+cdef void _update_by_y(value_t[:, ::1] tree,
+                       int64_t row, int64_t M, int64_t qyLo, int64_t qyHi, sum_t v,
+                       int64_t xWidth, bint covered) noexcept nogil:
+    """
+    Updates along y dimension
+    """
+    cdef int64_t l = qyLo + M
+    cdef int64_t r = qyHi + M + 1
+    cdef int64_t lo = qyLo + M
+    cdef int64_t hi = qyHi + M
+    cdef int64_t yWidth = 1
+
+    # One bottom-up pass, see sumQueryNumba._update_by_y.
+    while True:
+        # Nodes fully inside on y-dimension.
+        if l < r:
+            if l & 1:
+                if covered:
+                    # Fully inside on both dimensions.
+                    tree[row + l, _FB] += <value_t>v
+                    tree[row + l, _PY] += <value_t>(v * yWidth)
+                else:
+                    # Fully inside on y but not x.
+                    tree[row + l, _PX] += <value_t>(v * xWidth)
+                    tree[row + l, _PB] += <value_t>(v * xWidth * yWidth)
+                l += 1
+            if r & 1:
+                r -= 1
+                if covered:
+                    tree[row + r, _FB] += <value_t>v
+                    tree[row + r, _PY] += <value_t>(v * yWidth)
+                else:
+                    tree[row + r, _PX] += <value_t>(v * xWidth)
+                    tree[row + r, _PB] += <value_t>(v * xWidth * yWidth)
+            l >>= 1
+            r >>= 1
+
+        if lo == 1:
+            break
+        lo >>= 1
+        hi >>= 1
+        yWidth <<= 1
+
+        # Nodes partially inside on y-dimension.
+        if _overlap(qyLo, yWidth, qyLo, qyHi) < yWidth:
+            tree[row + lo, _PB] = tree[row + 2 * lo, _PB] + tree[row + 2 * lo + 1, _PB] + tree[row + lo, _PX] * yWidth
+            tree[row + lo, _PY] = tree[row + 2 * lo, _PY] + tree[row + 2 * lo + 1, _PY] + tree[row + lo, _FB] * yWidth
+        if hi != lo and _overlap(qyHi, yWidth, qyLo, qyHi) < yWidth:
+            tree[row + hi, _PB] = tree[row + 2 * hi, _PB] + tree[row + 2 * hi + 1, _PB] + tree[row + hi, _PX] * yWidth
+            tree[row + hi, _PY] = tree[row + 2 * hi, _PY] + tree[row + 2 * hi + 1, _PY] + tree[row + hi, _FB] * yWidth
+
+
+cdef int64_t _x_nodes(int64_t N, int64_t qxLo, int64_t qxHi,
+                      int64_t* nodes, int64_t* widths, int64_t* covered) noexcept nogil:
+    """
+    Lists the 1st layer nodes touched by [qxLo, qxHi] and returns how many there are
+    """
+    cdef int64_t count = 0
+    cdef int64_t l = qxLo + N
+    cdef int64_t r = qxHi + N + 1
+    cdef int64_t xWidth = 1
+    cdef int64_t lo, hi, width
+
+    # Nodes fully inside on x-dimension.
+    while l < r:
+        if l & 1:
+            nodes[count] = l
+            widths[count] = xWidth
+            covered[count] = 1
+            count += 1
+            l += 1
+        if r & 1:
+            r -= 1
+            nodes[count] = r
+            widths[count] = xWidth
+            covered[count] = 1
+            count += 1
+        l >>= 1
+        r >>= 1
+        xWidth <<= 1
+
+    # Nodes partially inside on x-dimension.
+    lo = qxLo + N
+    hi = qxHi + N
+    width = 1
+    while lo > 1:
+        lo >>= 1
+        hi >>= 1
+        width <<= 1
+        xWidth = _overlap(qxLo, width, qxLo, qxHi)
+        if xWidth < width:
+            nodes[count] = lo
+            widths[count] = xWidth
+            covered[count] = 0
+            count += 1
+        if hi != lo:
+            xWidth = _overlap(qxHi, width, qxLo, qxHi)
+            if xWidth < width:
+                nodes[count] = hi
+                widths[count] = xWidth
+                covered[count] = 0
+                count += 1
+    return count
+
+
+def update_by_x(value_t[:, ::1] tree, int64_t N, int64_t M,
+                int64_t qxLo, int64_t qxHi, int64_t qyLo, int64_t qyHi, sum_t v):
+    """
+    Updates along x dimension, see sumQueryNumba.update_by_x
+    """
+    cdef int64_t nodes[_MAX_NODES]
+    cdef int64_t widths[_MAX_NODES]
+    cdef int64_t covered[_MAX_NODES]
+    cdef int64_t count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    cdef int64_t stride = 2 * M
+    cdef int64_t t
+    for t in range(count):
+        _update_by_y(tree, nodes[t] * stride, M, qyLo, qyHi, v, widths[t], covered[t] == 1)
+
+
+def update_by_x_parallel(value_t[:, ::1] tree, int64_t N, int64_t M,
+                         int64_t qxLo, int64_t qxHi, int64_t qyLo, int64_t qyHi, sum_t v):
+    """
+    Same as update_by_x, but updates the x nodes in parallel. Only runs in parallel if the
+    extension was compiled with OpenMP.
+    """
+    cdef int64_t nodes[_MAX_NODES]
+    cdef int64_t widths[_MAX_NODES]
+    cdef int64_t covered[_MAX_NODES]
+    cdef int64_t count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    cdef int64_t stride = 2 * M
+    cdef int64_t t
+    for t in prange(count, nogil=True):
+        _update_by_y(tree, nodes[t] * stride, M, qyLo, qyHi, v, widths[t], covered[t] == 1)
+
+
+def update_batch(value_t[:, ::1] tree, int64_t N, int64_t M,
+                 int64_t[::1] qxLo, int64_t[::1] qxHi, int64_t[::1] qyLo, int64_t[::1] qyHi, sum_t[::1] v):
+    """
+    Applies a batch of updates in order, see sumQueryNumba.update_batch
+    """
+    cdef int64_t nodes[_MAX_NODES]
+    cdef int64_t widths[_MAX_NODES]
+    cdef int64_t covered[_MAX_NODES]
+    cdef int64_t stride = 2 * M
+    cdef int64_t b, t, count
+    with nogil:
+        for b in range(qxLo.shape[0]):
+            count = _x_nodes(N, qxLo[b], qxHi[b], nodes, widths, covered)
+            for t in range(count):
+                _update_by_y(tree, nodes[t] * stride, M, qyLo[b], qyHi[b], v[b], widths[t], covered[t] == 1)
+
+
+cdef sum_t _query_by_y(value_t[:, ::1] tree, sum_t result,
+                       int64_t row, int64_t M, int64_t qyLo, int64_t qyHi,
+                       int64_t xWidth, bint covered) noexcept nogil:
+    """
+    Queries along y dimension, adding the sum to result
+    """
+    cdef int64_t l = qyLo + M
+    cdef int64_t r = qyHi + M + 1
+    cdef int64_t lo, hi, width, yWidth
+
+    # Nodes fully inside on y-dimension.
+    while l < r:
+        if l & 1:
+            result += <sum_t>(tree[row + l, _PY] * xWidth)
+            if covered:
+                # Fully inside on both dimensions.
+                result += <sum_t>(tree[row + l, _PB])
+            l += 1
+        if r & 1:
+            r -= 1
+            result += <sum_t>(tree[row + r, _PY] * xWidth)
+            if covered:
+                result += <sum_t>(tree[row + r, _PB])
+        l >>= 1
+        r >>= 1
+
+    # Nodes partially inside on y-dimension.
+    lo = qyLo + M
+    hi = qyHi + M
+    width = 1
+    while lo > 1:
+        lo >>= 1
+        hi >>= 1
+        width <<= 1
+        yWidth = _overlap(qyLo, width, qyLo, qyHi)
+        if yWidth < width:
+            result += <sum_t>(tree[row + lo, _FB] * xWidth * yWidth)
+            if covered:
+                result += <sum_t>(tree[row + lo, _PX] * yWidth)
+        if hi != lo:
+            yWidth = _overlap(qyHi, width, qyLo, qyHi)
+            if yWidth < width:
+                result += <sum_t>(tree[row + hi, _FB] * xWidth * yWidth)
+                if covered:
+                    result += <sum_t>(tree[row + hi, _PX] * yWidth)
+    return result
+
+
+cdef sum_t _query_by_x(value_t[:, ::1] tree, sum_t result,
+                       int64_t N, int64_t M, int64_t qxLo, int64_t qxHi, int64_t qyLo, int64_t qyHi) noexcept nogil:
+    """
+    Queries along x dimension, adding the sum to result
+    """
+    cdef int64_t nodes[_MAX_NODES]
+    cdef int64_t widths[_MAX_NODES]
+    cdef int64_t covered[_MAX_NODES]
+    cdef int64_t count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    cdef int64_t stride = 2 * M
+    cdef int64_t t
+    for t in range(count):
+        result = _query_by_y(tree, result, nodes[t] * stride, M, qyLo, qyHi, widths[t], covered[t] == 1)
+    return result
+
+
+cdef sum_t _query_by_x_parallel(value_t[:, ::1] tree, sum_t result,
+                                int64_t N, int64_t M, int64_t qxLo, int64_t qxHi, int64_t qyLo,
+                                int64_t qyHi) noexcept nogil:
+    """
+    Same as _query_by_x, but queries the x nodes in parallel
+    """
+    cdef int64_t nodes[_MAX_NODES]
+    cdef int64_t widths[_MAX_NODES]
+    cdef int64_t covered[_MAX_NODES]
+    cdef int64_t count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    cdef int64_t stride = 2 * M
+    cdef int64_t t
+    for t in prange(count):
+        result += _query_by_y(tree, <sum_t>0, nodes[t] * stride, M, qyLo, qyHi, widths[t], covered[t] == 1)
+    return result
+
+
+def query_by_x(value_t[:, ::1] tree, int64_t N, int64_t M,
+               int64_t qxLo, int64_t qxHi, int64_t qyLo, int64_t qyHi):
+    """
+    Queries along x dimension, see sumQueryNumba.query_by_x
+    """
+    if value_t is double:
+        return _query_by_x(tree, <double>0, N, M, qxLo, qxHi, qyLo, qyHi)
+    else:
+        return _query_by_x(tree, <int64_t>0, N, M, qxLo, qxHi, qyLo, qyHi)
+
+
+def query_by_x_parallel(value_t[:, ::1] tree, int64_t N, int64_t M,
+                        int64_t qxLo, int64_t qxHi, int64_t qyLo, int64_t qyHi):
+    """
+    Same as query_by_x, but queries the x nodes in parallel. Only runs in parallel if the
+    extension was compiled with OpenMP.
+    """
+    if value_t is double:
+        return _query_by_x_parallel(tree, <double>0, N, M, qxLo, qxHi, qyLo, qyHi)
+    else:
+        return _query_by_x_parallel(tree, <int64_t>0, N, M, qxLo, qxHi, qyLo, qyHi)
+
+
+def query_batch(value_t[:, ::1] tree, int64_t N, int64_t M,
+                int64_t[::1] qxLo, int64_t[::1] qxHi, int64_t[::1] qyLo, int64_t[::1] qyHi, sum_t[::1] out):
+    """
+    Answers a batch of queries, see sumQueryNumba.query_batch
+    """
+    cdef int64_t b
+    with nogil:
+        for b in range(qxLo.shape[0]):
+            out[b] = _query_by_x(tree, <sum_t>0, N, M, qxLo[b], qxHi[b], qyLo[b], qyHi[b])
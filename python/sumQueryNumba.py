@@ -0,0 +1,363 @@
+""" Numba kernels of the 2D Segment Tree, see sumQuery.py for the layout of the tree
+
+Author : Rickard Norlander
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+# The kernels are compiled eagerly for every supported dtype of the tree, so they are ready at
+# import time. Values and sums are int64 for the integer trees, whatever the storage type, and
+# float64 for the float64 tree.
+DTYPES = ("int64", "int32", "float64")
+_SUMS = {"int64": "int64", "int32": "int64", "float64": "float64"}
+
+
+def _signatures(template):
+    """
+    Expands {tree} in template to the type of the tree array and {sum} to the type of its values
+    and sums, once per dtype
+    """
+    return [template.format(tree="%s[:, ::1]" % dtype, sum=_SUMS[dtype]) for dtype in DTYPES]
+
+
+# Columns of the tree array.
+_PB, _PY, _PX, _FB = 0, 1, 2, 3
+
+# Upper bound on the number of 1st layer nodes touched by a range, four per level. The x kernels
+# list those nodes in a scratch array of shape (3, MAX_NODES). It is allocated by each call,
+# or once per batch, rather than kept on the tree, so that concurrent queries don't share it.
+MAX_NODES = 256
+
+
+@njit('int64(int64, int64, int64, int64)', cache=True)
+def _overlap(c, width, qLo, qHi):
+    """
+    Number of coordinates within [qLo, qHi] of the node of the given width that contains
+    coordinate c. As the trees are padded to a power of two, its bounds are just c with the low
+    bits below width cleared and set.
+
+    Arguments:
+        c {int} -- coordinate within the node
+        width {int} -- number of leaves below the node, a power of two
+        qLo {int} -- start of the range
+        qHi {int} -- end of the range
+    """
+    mask = width - 1
+    lo = c & ~mask
+    hi = c | mask
+    lo = qLo if qLo > lo else lo
+    hi = qHi if qHi < hi else hi
+    return hi - lo + 1
+
+
+@njit(_signatures('void({tree}, int64, int64, int64, int64, {sum}, int64, boolean)'), cache=True)
+def _update_by_y(tree, row, M, qyLo, qyHi, v, xWidth, covered):
+    """
+    Updates along y dimension
+
+    Arguments:
+        tree {ndarray} -- one row of (partialBoth, partialY, partialX, fullBoth) per node
+        row {int} -- offset of the 2nd layer tree of the x node
+        M {int} -- number of leaves of the 2nd layer tree
+        qyLo {int} -- start of y dimension of update region
+        qyHi {int} -- end of y dimension of update region
+        v {int/float} -- value to be added, float only for a float64 tree
+        xWidth {int} -- number of x coordinates of the x node within the update region
+        covered {bool} -- True if x region is fully contained within the update region
+    """
+    # One bottom-up pass. At each height the nodes fully inside on y-dimension are updated, and
+    # then the parents of the boundary nodes lo and hi are recomputed if they are partially inside,
+    # while the children just written are still in cache.
+    l = qyLo + M
+    r = qyHi + M + 1
+    lo = qyLo + M
+    hi = qyHi + M
+    yWidth = 1
+    while True:
+        # Nodes fully inside on y-dimension.
+        if l < r:
+            if l & 1:
+                if covered:
+                    # Fully inside on both dimensions.
+                    tree[row + l, _FB] += v
+                    tree[row + l, _PY] += v * yWidth
+                else:
+                    # Fully inside on y but not x.
+                    tree[row + l, _PX] += v * xWidth
+                    tree[row + l, _PB] += v * xWidth * yWidth
+                l += 1
+            if r & 1:
+                r -= 1
+                if covered:
+                    tree[row + r, _FB] += v
+                    tree[row + r, _PY] += v * yWidth
+                else:
+                    tree[row + r, _PX] += v * xWidth
+                    tree[row + r, _PB] += v * xWidth * yWidth
+            l >>= 1
+            r >>= 1
+
+        if lo == 1:
+            break
+        lo >>= 1
+        hi >>= 1
+        yWidth <<= 1
+
+        # Nodes partially inside on y-dimension.
+        if _overlap(qyLo, yWidth, qyLo, qyHi) < yWidth:
+            tree[row + lo, _PB] = tree[row + 2 * lo, _PB] + tree[row + 2 * lo + 1, _PB] + tree[row + lo, _PX] * yWidth
+            tree[row + lo, _PY] = tree[row + 2 * lo, _PY] + tree[row + 2 * lo + 1, _PY] + tree[row + lo, _FB] * yWidth
+        if hi != lo and _overlap(qyHi, yWidth, qyLo, qyHi) < yWidth:
+            tree[row + hi, _PB] = tree[row + 2 * hi, _PB] + tree[row + 2 * hi + 1, _PB] + tree[row + hi, _PX] * yWidth
+            tree[row + hi, _PY] = tree[row + 2 * hi, _PY] + tree[row + 2 * hi + 1, _PY] + tree[row + hi, _FB] * yWidth
+
+
+@njit('int64(int64, int64, int64, int64[::1], int64[::1], int64[::1])', cache=True)
+def _x_nodes(N, qxLo, qxHi, nodes, widths, covered):
+    """
+    Lists the 1st layer nodes touched by [qxLo, qxHi] and returns how many there are
+
+    Arguments:
+        N {int} -- number of leaves of the 1st layer tree
+        qxLo {int} -- start of x dimension of the region
+        qxHi {int} -- end of x dimension of the region
+        nodes {ndarray} -- receives the index of each node
+        widths {ndarray} -- receives the number of x coordinates of each node within the region
+        covered {ndarray} -- receives 1 for the nodes fully inside the region, else 0
+    """
+    count = 0
+
+    # Nodes fully inside on x-dimension.
+    l = qxLo + N
+    r = qxHi + N + 1
+    xWidth = 1
+    while l < r:
+        if l & 1:
+            nodes[count] = l
+            widths[count] = xWidth
+            covered[count] = 1
+            count += 1
+            l += 1
+        if r & 1:
+            r -= 1
+            nodes[count] = r
+            widths[count] = xWidth
+            covered[count] = 1
+            count += 1
+        l >>= 1
+        r >>= 1
+        xWidth <<= 1
+
+    # Nodes partially inside on x-dimension.
+    lo = qxLo + N
+    hi = qxHi + N
+    width = 1
+    while lo > 1:
+        lo >>= 1
+        hi >>= 1
+        width <<= 1
+        xWidth = _overlap(qxLo, width, qxLo, qxHi)
+        if xWidth < width:
+            nodes[count] = lo
+            widths[count] = xWidth
+            covered[count] = 0
+            count += 1
+        if hi != lo:
+            xWidth = _overlap(qxHi, width, qxLo, qxHi)
+            if xWidth < width:
+                nodes[count] = hi
+                widths[count] = xWidth
+                covered[count] = 0
+                count += 1
+    return count
+
+
+@njit(_signatures('void({tree}, int64, int64, int64, int64, int64, int64, {sum})'), cache=True)
+def update_by_x(tree, N, M, qxLo, qxHi, qyLo, qyHi, v):
+    """
+    Updates along x dimension
+
+    Arguments:
+        tree {ndarray} -- one row of (partialBoth, partialY, partialX, fullBoth) per node
+        N {int} -- number of leaves of the 1st layer tree
+        M {int} -- number of leaves of the 2nd layer tree
+        qxLo {int} -- start of x dimension of update region
+        qxHi {int} -- end of x dimension of update region
+        qyLo {int} -- start of y dimension of update region
+        qyHi {int} -- end of y dimension of update region
+        v {int/float} -- value to be added, float only for a float64 tree
+    """
+    scratch = np.empty((3, MAX_NODES), np.int64)
+    nodes = scratch[0]
+    widths = scratch[1]
+    covered = scratch[2]
+    count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    stride = 2 * M
+    for t in range(count):
+        _update_by_y(tree, nodes[t] * stride, M, qyLo, qyHi, v, widths[t], covered[t] == 1)
+
+
+@njit(_signatures('void({tree}, int64, int64, int64, int64, int64, int64, {sum})'), parallel=True, cache=True)
+def update_by_x_parallel(tree, N, M, qxLo, qxHi, qyLo, qyHi, v):
+    """
+    Same as update_by_x, but updates the x nodes in parallel. Each x node has a 2nd layer tree
+    of its own, so the threads never write to the same element.
+    """
+    scratch = np.empty((3, MAX_NODES), np.int64)
+    nodes = scratch[0]
+    widths = scratch[1]
+    covered = scratch[2]
+    count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    stride = 2 * M
+    for t in prange(count):
+        _update_by_y(tree, nodes[t] * stride, M, qyLo, qyHi, v, widths[t], covered[t] == 1)
+
+
+@njit(_signatures('void({tree}, int64, int64, int64[::1], int64[::1], int64[::1], int64[::1], {sum}[::1])'),
+      cache=True)
+def update_batch(tree, N, M, qxLo, qxHi, qyLo, qyHi, v):
+    """
+    Applies a batch of updates in order, see update_by_x
+
+    Arguments:
+        tree {ndarray} -- one row of (partialBoth, partialY, partialX, fullBoth) per node
+        N {int} -- number of leaves of the 1st layer tree
+        M {int} -- number of leaves of the 2nd layer tree
+        qxLo, qxHi, qyLo, qyHi, v {ndarray} -- one entry per update
+    """
+    scratch = np.empty((3, MAX_NODES), np.int64)
+    nodes = scratch[0]
+    widths = scratch[1]
+    covered = scratch[2]
+    stride = 2 * M
+    for b in range(qxLo.shape[0]):
+        count = _x_nodes(N, qxLo[b], qxHi[b], nodes, widths, covered)
+        for t in range(count):
+            _update_by_y(tree, nodes[t] * stride, M, qyLo[b], qyHi[b], v[b], widths[t], covered[t] == 1)
+
+
+@njit(_signatures('{sum}({tree}, int64, int64, int64, int64, int64, boolean)'), cache=True)
+def _query_by_y(tree, row, M, qyLo, qyHi, xWidth, covered):
+    """
+    Queries along y dimension
+
+    Arguments:
+        tree {ndarray} -- one row of (partialBoth, partialY, partialX, fullBoth) per node
+        row {int} -- offset of the 2nd layer tree of the x node
+        M {int} -- number of leaves of the 2nd layer tree
+        qyLo {int} -- start of y dimension of query region
+        qyHi {int} -- end of y dimension of query region
+        xWidth {int} -- number of x coordinates of the x node within the query region
+        covered {bool} -- True if x region is fully contained within the query region
+    """
+    result = 0
+
+    # Nodes fully inside on y-dimension.
+    l = qyLo + M
+    r = qyHi + M + 1
+    while l < r:
+        if l & 1:
+            result += tree[row + l, _PY] * xWidth
+            if covered:
+                # Fully inside on both dimensions.
+                result += tree[row + l, _PB]
+            l += 1
+        if r & 1:
+            r -= 1
+            result += tree[row + r, _PY] * xWidth
+            if covered:
+                result += tree[row + r, _PB]
+        l >>= 1
+        r >>= 1
+
+    # Nodes partially inside on y-dimension.
+    lo = qyLo + M
+    hi = qyHi + M
+    width = 1
+    while lo > 1:
+        lo >>= 1
+        hi >>= 1
+        width <<= 1
+        yWidth = _overlap(qyLo, width, qyLo, qyHi)
+        if yWidth < width:
+            result += tree[row + lo, _FB] * xWidth * yWidth
+            if covered:
+                result += tree[row + lo, _PX] * yWidth
+        if hi != lo:
+            yWidth = _overlap(qyHi, width, qyLo, qyHi)
+            if yWidth < width:
+                result += tree[row + hi, _FB] * xWidth * yWidth
+                if covered:
+                    result += tree[row + hi, _PX] * yWidth
+    return result
+
+
+@njit(_signatures('{sum}({tree}, int64, int64, int64, int64, int64, int64)'), cache=True)
+def query_by_x(tree, N, M, qxLo, qxHi, qyLo, qyHi):
+    """
+    Queries along x dimension
+
+    Arguments:
+        tree {ndarray} -- one row of (partialBoth, partialY, partialX, fullBoth) per node
+        N {int} -- number of leaves of the 1st layer tree
+        M {int} -- number of leaves of the 2nd layer tree
+        qxLo {int} -- start of x dimension of query region
+        qxHi {int} -- end of x dimension of query region
+        qyLo {int} -- start of y dimension of query region
+        qyHi {int} -- end of y dimension of query region
+    """
+    scratch = np.empty((3, MAX_NODES), np.int64)
+    nodes = scratch[0]
+    widths = scratch[1]
+    covered = scratch[2]
+    count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    stride = 2 * M
+    result = 0
+    for t in range(count):
+        result += _query_by_y(tree, nodes[t] * stride, M, qyLo, qyHi, widths[t], covered[t] == 1)
+    return result
+
+
+@njit(_signatures('{sum}({tree}, int64, int64, int64, int64, int64, int64)'), parallel=True, cache=True)
+def query_by_x_parallel(tree, N, M, qxLo, qxHi, qyLo, qyHi):
+    """
+    Same as query_by_x, but queries the x nodes in parallel
+    """
+    scratch = np.empty((3, MAX_NODES), np.int64)
+    nodes = scratch[0]
+    widths = scratch[1]
+    covered = scratch[2]
+    count = _x_nodes(N, qxLo, qxHi, nodes, widths, covered)
+    stride = 2 * M
+    result = 0
+    for t in prange(count):
+        result += _query_by_y(tree, nodes[t] * stride, M, qyLo, qyHi, widths[t], covered[t] == 1)
+    return result
+
+
+@njit(_signatures('void({tree}, int64, int64, int64[::1], int64[::1], int64[::1], int64[::1], {sum}[::1])'),
+      cache=True)
+def query_batch(tree, N, M, qxLo, qxHi, qyLo, qyHi, out):
+    """
+    Answers a batch of queries, see query_by_x
+
+    Arguments:
+        tree {ndarray} -- one row of (partialBoth, partialY, partialX, fullBoth) per node
+        N {int} -- number of leaves of the 1st layer tree
+        M {int} -- number of leaves of the 2nd layer tree
+        qxLo, qxHi, qyLo, qyHi {ndarray} -- one entry per query
+        out {ndarray} -- receives the answer to each query
+    """
+    scratch = np.empty((3, MAX_NODES), np.int64)
+    nodes = scratch[0]
+    widths = scratch[1]
+    covered = scratch[2]
+    stride = 2 * M
+    for b in range(qxLo.shape[0]):
+        count = _x_nodes(N, qxLo[b], qxHi[b], nodes, widths, covered)
+        result = 0
+        for t in range(count):
+            result += _query_by_y(tree, nodes[t] * stride, M, qyLo[b], qyHi[b], widths[t], covered[t] == 1)
+        out[b] = result
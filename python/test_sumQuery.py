@@ -0,0 +1,206 @@
+""" Tests of the 2D Segment Tree against a plain numpy matrix
+
+Run with python -m pytest in this directory. The Cython tests are skipped unless sumQueryExt has
+been built, and the GPU tests unless there is a CUDA device (or NUMBA_ENABLE_CUDASIM=1).
+
+Author : Rickard Norlander
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+import sumQuery
+import sumQueryNumba
+from sumQuery import SegmentTree2D
+
+KERNELS = ("DTYPES", "update_by_x", "update_by_x_parallel", "update_batch", "query_by_x",
+           "query_by_x_parallel", "query_batch")
+
+SIZES = [(1, 1), (1, 9), (7, 1), (5, 5), (8, 8), (13, 6), (33, 17)]
+
+DTYPES = [np.int64, np.int32, np.float64]
+
+
+@pytest.fixture(params=["numba", "cython"])
+def backend(request, monkeypatch):
+    """
+    Points sumQuery at the kernels of one backend
+    """
+    if request.param == "numba":
+        module = sumQueryNumba
+    else:
+        module = pytest.importorskip("sumQueryExt")
+    for name in KERNELS:
+        monkeypatch.setattr(sumQuery, name, getattr(module, name))
+    return module
+
+
+def randomRanges(rnd, n, m, count, margin=0):
+    """
+    Random ranges, reaching margin coordinates outside of the matrix on each side
+    """
+    qxLo = rnd.integers(-margin, n + margin, count)
+    qxHi = qxLo + rnd.integers(0, n + margin, count)
+    qyLo = rnd.integers(-margin, m + margin, count)
+    qyHi = qyLo + rnd.integers(0, m + margin, count)
+    return qxLo, qxHi, qyLo, qyHi
+
+
+def window(matrix, qxLo, qxHi, qyLo, qyHi):
+    """
+    The part of matrix within [qxLo:qxHi,qyLo:qyHi], clipped the same way as the tree
+    """
+    return matrix[max(qxLo, 0):max(qxHi + 1, 0), max(qyLo, 0):max(qyHi + 1, 0)]
+
+
+def randomValues(rnd, dtype, count):
+    """
+    Random update values, quarters for a float tree so that the sums are exact
+    """
+    v = rnd.integers(-9, 10, count)
+    return v / 4 if np.dtype(dtype).kind == "f" else v
+
+
+def referenceMatrix(n, m, dtype):
+    return np.zeros((n, m), dtype=np.float64 if np.dtype(dtype).kind == "f" else np.int64)
+
+
+@pytest.mark.parametrize("n, m", SIZES)
+@pytest.mark.parametrize("dtype", DTYPES)
+@pytest.mark.parametrize("parallel", [False, True])
+def test_update_query(backend, n, m, dtype, parallel):
+    rnd = np.random.default_rng(n * 100 + m)
+    tree = SegmentTree2D(n, m, parallel=parallel, dtype=dtype)
+    matrix = referenceMatrix(n, m, dtype)
+    for qxLo, qxHi, qyLo, qyHi in zip(*randomRanges(rnd, n, m, 60, margin=2)):
+        v = randomValues(rnd, dtype, 1)[0].item()
+        tree.update(int(qxLo), int(qxHi), int(qyLo), int(qyHi), v)
+        window(matrix, qxLo, qxHi, qyLo, qyHi)[...] += v
+        for x in zip(*randomRanges(rnd, n, m, 3, margin=2)):
+            assert tree.query(*(int(c) for c in x)) == window(matrix, *x).sum()
+
+
+@pytest.mark.parametrize("n, m", SIZES)
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_batches(backend, n, m, dtype):
+    rnd = np.random.default_rng(n * 100 + m)
+    tree = SegmentTree2D(n, m, dtype=dtype)
+    matrix = referenceMatrix(n, m, dtype)
+    updates = randomRanges(rnd, n, m, 200, margin=2)
+    v = randomValues(rnd, dtype, 200)
+    tree.updateBatch(*updates, v)
+    for k, x in enumerate(zip(*updates)):
+        window(matrix, *x)[...] += v[k]
+    queries = randomRanges(rnd, n, m, 200, margin=2)
+    expected = [window(matrix, *x).sum() for x in zip(*queries)]
+    assert tree.queryBatch(*queries).tolist() == expected
+    assert tree.queryBatch([], [], [], []).shape == (0,)
+
+    # Scalars broadcast against the arrays.
+    tree.updateBatch(0, n - 1, *queries[2:], 1)
+    for qyLo, qyHi in zip(*queries[2:]):
+        window(matrix, 0, n - 1, qyLo, qyHi)[...] += 1
+    expected = [window(matrix, *x).sum() for x in zip(*queries)]
+    assert tree.queryBatch(*queries).tolist() == expected
+
+
+def test_concurrent_queries(backend):
+    rnd = np.random.default_rng(0)
+    tree = SegmentTree2D(200, 200)
+    tree.updateBatch(*randomRanges(rnd, 200, 200, 500), 3)
+    queries = randomRanges(rnd, 200, 200, 2000)
+    expected = tree.queryBatch(*queries)
+    results = []
+
+    def work():
+        for _ in range(5):
+            results.append(tree.queryBatch(*queries))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all((result == expected).all() for result in results)
+
+
+@pytest.mark.skipif(sumQuery.sumQueryCuda is None or not sumQuery.sumQueryCuda.available(),
+                    reason="no CUDA device")
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_gpu(dtype):
+    rnd = np.random.default_rng(1)
+    tree = SegmentTree2D(13, 6, dtype=dtype)
+    tree.updateBatch(*randomRanges(rnd, 13, 6, 50), randomValues(rnd, dtype, 50))
+    queries = randomRanges(rnd, 13, 6, 100, margin=2)
+    assert tree.queryBatch(*queries, gpu=True).tolist() == tree.queryBatch(*queries).tolist()
+    # The copy on the device is dropped by updates.
+    tree.update(0, 12, 0, 5, 1)
+    assert tree.queryBatch(*queries, gpu=True).tolist() == tree.queryBatch(*queries).tolist()
+
+
+def test_gpu_unavailable(monkeypatch):
+    monkeypatch.setattr(sumQuery, "sumQueryCuda", None)
+    with pytest.raises(RuntimeError):
+        SegmentTree2D(3, 3).queryBatch([0], [1], [0], [1], gpu=True)
+
+
+def test_numpy_sizes():
+    tree = SegmentTree2D(np.int64(5), np.int32(3))
+    tree.update(np.int64(0), np.int64(4), 0, 2, np.int8(2))
+    assert tree.query(0, 4, 0, 2) == 30
+
+
+def test_rejects_non_integers():
+    tree = SegmentTree2D(3, 3)
+    with pytest.raises(TypeError):
+        tree.update(0, 1, 0, 1, 1.5)
+    with pytest.raises(TypeError):
+        tree.query(0, 1.0, 0, 1)
+    with pytest.raises(TypeError):
+        tree.updateBatch([0], [1], [0], [1], [1.5])
+    with pytest.raises(TypeError):
+        tree.queryBatch([0.0], [1], [0], [1])
+    assert tree.query(0, 2, 0, 2) == 0
+
+
+def test_huge_bounds(backend):
+    tree = SegmentTree2D(3, 3)
+    tree.update(0, 2, 0, 2, 1)
+    bounds = [-2**70, -2**63 - 1, -1, 0, 2, 2**63 - 1, 2**63, 2**64 - 1, 2**70]
+    for lo in bounds:
+        for hi in bounds:
+            expected = [tree.query(0, hi, lo, 2), tree.query(lo, 2, 0, hi)]
+            assert tree.queryBatch([0, lo], [hi, 2], [lo, 0], [2, hi]).tolist() == expected
+    unsigned = np.array([2**64 - 1], dtype=np.uint64)
+    assert tree.queryBatch([0], unsigned, [0], unsigned).tolist() == [tree.query(0, 2**64 - 1, 0, 2**64 - 1)]
+
+
+def test_rejects_huge_values(backend):
+    tree = SegmentTree2D(3, 3)
+    for v in [2**63, -2**63 - 1, 2**70]:
+        with pytest.raises(OverflowError):
+            tree.update(0, 0, 0, 0, v)
+        with pytest.raises(OverflowError):
+            tree.updateBatch([0], [0], [0], [0], [v])
+    with pytest.raises(OverflowError):
+        tree.updateBatch([0], [0], [0], [0], np.array([2**63], dtype=np.uint64))
+    assert tree.query(0, 2, 0, 2) == 0
+
+
+def test_float_values(backend):
+    tree = SegmentTree2D(3, 3, dtype=np.float64)
+    tree.update(0, 1, 0, 1, 1.5)
+    assert tree.query(0, 2, 0, 2) == 6.0
+    tree.updateBatch([0], [0], [0], [0], [0.25])
+    assert tree.queryBatch([0, 0], [0, 2], [0, 0], [0, 2]).tolist() == [1.75, 6.25]
+    with pytest.raises(TypeError):
+        tree.update(0, 1.0, 0, 1, 1.5)
+    with pytest.raises(TypeError):
+        tree.update(0, 1, 0, 1, "1.5")
+
+
+def test_rejects_dtype():
+    with pytest.raises(ValueError):
+        SegmentTree2D(3, 3, dtype=np.float32)